@@ -1,9 +1,13 @@
 import os
+import re
+import sys
 import time
 import json
+import hashlib
 import asyncio
-import psycopg2
-from psycopg2.extras import RealDictCursor
+import logging
+from http.cookies import SimpleCookie
+import asyncpg
 from dotenv import load_dotenv
 from gemini_webapi import GeminiClient
 from gemini_webapi.constants import Model
@@ -11,6 +15,9 @@ from gemini_webapi.constants import Model
 # Load environment variables
 load_dotenv()
 
+logging.basicConfig(level=os.getenv("LOG_LEVEL", "INFO"), format="%(asctime)s %(message)s")
+logger = logging.getLogger("gen")
+
 # Database Configuration
 # Database Configuration - MUST be set via environment variable (GitHub Secret)
 DATABASE_URL = os.getenv("DATABASE_URL")
@@ -21,6 +28,35 @@ if not DATABASE_URL:
 SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
 COOKIES_FILE = os.path.join(SCRIPT_DIR, "cookies.txt")
 
+# Concurrency / rate limiting for Gemini requests
+CONCURRENCY = max(1, int(os.getenv("GEMINI_CONCURRENCY", "4")))
+RATE_PER_MIN = float(os.getenv("GEMINI_RATE_PER_MIN", "12"))
+if RATE_PER_MIN <= 0:
+    raise ValueError("GEMINI_RATE_PER_MIN must be greater than 0.")
+
+# Bounds for the adaptive delay each worker waits between records
+MIN_DELAY = float(os.getenv("MIN_DELAY", "2"))
+MAX_DELAY = float(os.getenv("MAX_DELAY", "60"))
+if MIN_DELAY <= 0 or MIN_DELAY > MAX_DELAY:
+    raise ValueError("MIN_DELAY must be greater than 0 and not greater than MAX_DELAY.")
+
+
+def reject_json_constant(name):
+    """NaN/Infinity are accepted by Python's json module but rejected by Postgres jsonb."""
+    raise ValueError(f"Unsupported JSON constant: {name}")
+
+
+JSON_DECODER = json.JSONDecoder(parse_constant=reject_json_constant)
+
+# Trailing SKU / model codes stripped from titles before computing cache keys
+TITLE_SKU_RE = re.compile(r'\s+MS\d+$|\s+SKU[\w-]+$', re.I)
+
+# Marker used to detect that a streamed response has reached its last field
+PART2_KEY = '"part2_prompt"'
+
+# Number of generated prompts buffered before writing them to the database
+FLUSH_EVERY = 8
+
 VEO3_PROMPT_TEMPLATE = """You are an Elite AI Commercial Director.
 Your task is to generate a 2-part video prompt must be **22 to 28 words** per part to JSON Only for Google Veo 3 based on the raw product title. DO NOT PRINT TO CHAT PROCESSING LOGIC FOR EVERY STEPS.
 
@@ -66,260 +102,541 @@ Your task is to generate a 2-part video prompt must be **22 to 28 words** per pa
 }}
 """
 
+# Split the template around the title once at import so building a prompt is a
+# plain concatenation. The escaped braces are unescaped here, as format() would.
+PROMPT_HEAD, PROMPT_TAIL = (
+    part.replace("{{", "{").replace("}}", "}")
+    for part in VEO3_PROMPT_TEMPLATE.split("{title}", 1)
+)
 
-def load_cookies_from_file(filepath):
-    """Load cookies from text file in format: COOKIE1=value1;COOKIE2=value2;..."""
-    if not os.path.exists(filepath):
-        raise FileNotFoundError(f"Cookies file not found: {filepath}")
-    
-    with open(filepath, 'r', encoding='utf-8') as f:
-        cookie_string = f.read().strip()
-    
-    # Parse cookies
-    cookies = {}
-    for cookie in cookie_string.split(';'):
-        cookie = cookie.strip()
-        if '=' in cookie:
-            key, value = cookie.split('=', 1)
-            cookies[key] = value
-    
-    return cookies
+# The example output embedded in the template. A response that parses to exactly
+# this means Gemini echoed the prompt back instead of generating.
+TEMPLATE_EXAMPLE_JSON = json.loads(PROMPT_TAIL[PROMPT_TAIL.index("{"):])
 
 
-def load_cookies_from_env():
-    """Load cookies from environment variable GEMINI_COOKIES."""
-    cookie_string = os.getenv("GEMINI_COOKIES", "")
-    if not cookie_string:
-        return None
-    
+def parse_cookies(cookie_string):
+    """Parse cookies from a string in format: COOKIE1=value1;COOKIE2=value2;..."""
     cookies = {}
-    for cookie in cookie_string.split(';'):
-        cookie = cookie.strip()
-        if '=' in cookie:
-            key, value = cookie.split('=', 1)
+    # SimpleCookie drops the whole string on one malformed entry, so parse each
+    # entry on its own and fall back to a plain split for ones it rejects
+    for segment in cookie_string.split(';'):
+        cookie = SimpleCookie()
+        cookie.load(segment)
+        if cookie:
+            cookies.update((key, morsel.value) for key, morsel in cookie.items())
+        elif '=' in segment:
+            key, value = segment.strip().split('=', 1)
             cookies[key] = value
-    
-    return cookies if cookies else None
+    return cookies
 
 
-def get_db_connection():
-    """Establish a connection to the database."""
+async def get_db_pool():
+    """Create a connection pool; synchronous_commit is off since everything written can be regenerated."""
     try:
-        conn = psycopg2.connect(DATABASE_URL)
-        return conn
+        return await asyncpg.create_pool(
+            DATABASE_URL,
+            min_size=2,
+            max_size=8,
+            server_settings={"synchronous_commit": "off"},
+        )
     except Exception as e:
-        print(f"Error connecting to database: {e}")
+        logger.error("Error connecting to database: %s", e)
         return None
 
 
-def fetch_pending_records(conn, limit=300):
+async def fetch_pending_records(pool, limit=300):
     """
     Fetch pending records and mark them with crawl_status=TRUE to prevent
     other jobs from processing the same records.
     
-    Uses UPDATE ... RETURNING to atomically claim records.
+    Uses UPDATE ... RETURNING over a FOR UPDATE SKIP LOCKED CTE to atomically claim records.
     """
     try:
-        with conn.cursor(cursor_factory=RealDictCursor) as cur:
+        async with pool.acquire() as conn:
             # Atomically claim records by setting crawl_status = TRUE
             # Only select records where crawl_status IS NULL (not yet claimed)
-            cur.execute("""
-                UPDATE products_ai
-                SET crawl_status = TRUE
-                WHERE id IN (
+            # A single statement runs in its own implicit transaction
+            return await conn.fetch("""
+                WITH pending AS (
                     SELECT id FROM products_ai
-                    WHERE prompt_veo3 IS NULL 
+                    WHERE prompt_veo3 IS NULL
                       AND category = 'vip'
+                      AND crawl_status IS NULL
                     ORDER BY id ASC
-                    LIMIT %s
+                    LIMIT $1
+                    FOR UPDATE SKIP LOCKED
                 )
-                RETURNING id, title, image_data
-            """, (limit,))
-            records = cur.fetchall()
-            conn.commit()
-            return records
+                UPDATE products_ai p
+                SET crawl_status = TRUE
+                FROM pending
+                WHERE p.id = pending.id
+                RETURNING p.id, p.title, octet_length(p.image_data) AS img_size
+            """, limit)
     except Exception as e:
-        print(f"Error fetching records: {e}")
-        conn.rollback()
+        logger.error("Error fetching records: %s", e)
         return []
 
 
-def update_record(conn, record_id, prompt_veo3):
-    """Update the record with the generated Veo3 prompt."""
+async def mark_records_skipped(pool, record_ids):
+    """Set crawl_status=FALSE on records that can't be processed so they aren't claimed again. Returns the ids marked."""
     try:
-        with conn.cursor() as cur:
-            print(f"Attempting to update record {record_id} with prompt length: {len(prompt_veo3) if prompt_veo3 else 0}")
-            cur.execute("""
+        async with pool.acquire() as conn:
+            await conn.execute("""
                 UPDATE products_ai
-                SET prompt_veo3 = %s,
-                    updated_at = NOW()
-                WHERE id = %s
-            """, (prompt_veo3, record_id))
-            conn.commit()
-            print(f"Successfully updated record {record_id} with Veo3 prompt.")
+                SET crawl_status = FALSE
+                WHERE id = ANY($1::bigint[])
+            """, record_ids)
+        logger.warning("⚠️  Marked records %s as skipped (crawl_status = FALSE)", record_ids)
+        return record_ids
     except Exception as e:
-        print(f"Error updating record {record_id}: {e}")
-        conn.rollback()
+        logger.error("Error marking records %s as skipped: %s", record_ids, e)
+        return []
 
 
-def generate_prompt_text(record):
-    """Format the prompt using the template and record data."""
+async def fetch_cached_responses(pool, cache_keys):
+    """Look up cached responses for a batch of title cache keys in one query."""
+    if not cache_keys:
+        return {}
     try:
-        return VEO3_PROMPT_TEMPLATE.format(title=record['title'])
+        async with pool.acquire() as conn:
+            rows = await conn.fetch("""
+                SELECT title_hash, response FROM ai_prompt_cache
+                WHERE title_hash = ANY($1::bytea[])
+            """, list(cache_keys))
+        return {row['title_hash']: row['response'] for row in rows}
     except Exception as e:
-        print(f"Error formatting prompt for record {record['id']}: {e}")
-        return None
+        logger.error("Error fetching cached responses: %s", e)
+        return {}
 
 
-def clean_json_response(text):
-    """Clean markdown formatting and extract JSON object from response."""
-    text = text.strip()
+async def store_cached_responses(pool, entries):
+    """Best-effort insert of (cache_key, response) pairs into ai_prompt_cache."""
+    if not entries:
+        return
+    try:
+        async with pool.acquire() as conn:
+            await conn.execute("""
+                INSERT INTO ai_prompt_cache (title_hash, response)
+                SELECT * FROM unnest($1::bytea[], $2::jsonb[])
+                ON CONFLICT DO NOTHING
+            """, [key for key, _ in entries], [response for _, response in entries])
+    except Exception as e:
+        logger.error("Error storing cached responses: %s", e)
+
+
+async def flush_updates(pool, pending_updates):
+    """
+    Write buffered (id, prompt_veo3, cache_key) entries in one UPDATE and return the ids written.
+    A prompt of None releases the record's claim instead.
+    """
+    if not pending_updates:
+        return []
     
-    # Remove markdown code blocks if present
-    if text.startswith("```json"):
-        text = text[7:]
-    if text.startswith("```"):
-        text = text[3:]
-    if text.endswith("```"):
-        text = text[:-3]
+    batch = list(pending_updates)
+    pending_updates.clear()
+    record_ids = [record_id for record_id, _, _ in batch]
+    try:
+        async with pool.acquire() as conn:
+            logger.info("Flushing %d record update(s) to database...", len(batch))
+            await conn.execute("""
+                UPDATE products_ai
+                SET prompt_veo3 = COALESCE(data.p, products_ai.prompt_veo3),
+                    crawl_status = CASE WHEN data.p IS NULL THEN NULL ELSE products_ai.crawl_status END,
+                    updated_at = CASE WHEN data.p IS NULL THEN products_ai.updated_at ELSE NOW() END
+                FROM unnest($1::bigint[], $2::jsonb[]) AS data(id, p)
+                WHERE products_ai.id = data.id
+            """, record_ids, [prompt for _, prompt, _ in batch])
+        logger.info("Successfully updated records %s.", record_ids)
+    except Exception as e:
+        logger.error("Error flushing updates for records %s: %s", record_ids, e)
+    else:
+        await store_cached_responses(pool, [(key, prompt) for _, prompt, key in batch if key and prompt])
+        return record_ids
     
-    # Extract JSON object
+    # The batch couldn't be written; at least release the claims so the
+    # records are retried on a later run
     try:
-        start_index = text.find('{')
-        end_index = text.rfind('}')
-        if start_index != -1 and end_index != -1 and end_index > start_index:
-            text = text[start_index:end_index+1]
+        async with pool.acquire() as conn:
+            await conn.execute("""
+                UPDATE products_ai
+                SET crawl_status = NULL
+                WHERE id = ANY($1::bigint[])
+                  AND prompt_veo3 IS NULL
+            """, record_ids)
+        logger.warning("⚠️  Released records %s back to the queue.", record_ids)
+        return record_ids
     except Exception as e:
-        print(f"Warning: Could not extract JSON object: {e}")
+        logger.error("Error releasing records %s: %s", record_ids, e)
+        return []
+
+
+def is_valid_prompt_json(parsed_json):
+    """Check that a parsed response has both prompt parts and isn't the echoed template example."""
+    part1 = parsed_json.get("part1_prompt")
+    part2 = parsed_json.get("part2_prompt")
+    return (
+        isinstance(part1, str)
+        and isinstance(part2, str)
+        and len(part1) >= 50
+        and part1 != TEMPLATE_EXAMPLE_JSON["part1_prompt"]
+    )
+
+
+def title_cache_key(title):
+    """Cache key for a title: sha256 of the title without SKU suffix, lowercased."""
+    return hashlib.sha256(TITLE_SKU_RE.sub('', title).lower().encode()).digest()
+
+
+def generate_prompt_text(record):
+    """Build the prompt from the precomputed template halves and the record title."""
+    return PROMPT_HEAD + record['title'] + PROMPT_TAIL
+
+
+def parse_json_response(text):
+    """
+    Parse the first JSON object in the response, ignoring any markdown fences
+    or chatter around it, in a single raw_decode pass.
+    
+    Returns (parsed_object, json_text), or (None, None) if there is no object.
+    Raises ValueError (including json.JSONDecodeError) if the object is
+    malformed or can't be stored as jsonb (NaN/Infinity, \\u0000).
+    """
+    start_index = text.find('{')
+    if start_index == -1:
+        return None, None
+    parsed, end_index = JSON_DECODER.raw_decode(text, start_index)
+    json_text = text[start_index:end_index]
+    if "\\u0000" in json_text:
+        raise ValueError("JSON contains \\u0000, which jsonb can't store")
+    return parsed, json_text
+
+
+async def stream_response_text(client, prompt_text):
+    """
+    Stream the Gemini response and return its text.
+    
+    Stops reading as soon as the "part2_prompt" key has been seen and a chunk
+    closes the JSON object, instead of waiting for the whole generation.
+    """
+    chunks = []
+    tail = ""
+    seen_part2 = False
+    stream = client.generate_content_stream(
+        prompt=prompt_text,
+        model=Model.G_3_0_FLASH,
+    )
+    try:
+        async for output in stream:
+            delta = output.text_delta
+            if not delta:
+                continue
+            chunks.append(delta)
+            
+            # Only scan the new text (plus a small overlap) for the key
+            window = tail + delta
+            tail = window[-len(PART2_KEY):]
+            if not seen_part2:
+                seen_part2 = PART2_KEY in window
+            # The object usually arrives inside a ```json fence, so ignore a
+            # trailing fence (possibly split across chunks) before checking for "}"
+            if seen_part2 and window.rstrip().rstrip("`").rstrip().endswith("}"):
+                break
+    finally:
+        await stream.aclose()
+    
+    return "".join(chunks)
+
+
+class ConcurrencyLimiter:
+    """
+    Admission controller for in-flight Gemini requests.
+
+    A counter guarded by an asyncio.Condition, so the limit can be lowered
+    at runtime (e.g. on 429s) and waiters re-check it when notified.
+    """
+
+    def __init__(self, limit):
+        self.limit = max(1, limit)
+        self._in_flight = 0
+        self._cond = asyncio.Condition()
+
+    async def __aenter__(self):
+        async with self._cond:
+            await self._cond.wait_for(lambda: self._in_flight < self.limit)
+            self._in_flight += 1
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        async with self._cond:
+            self._in_flight -= 1
+            self._cond.notify_all()
+
+    async def set_limit(self, limit):
+        """Change the number of allowed in-flight requests (minimum 1)."""
+        async with self._cond:
+            self.limit = max(1, limit)
+            self._cond.notify_all()
+
+
+class TokenBucket:
+    """Token-bucket rate limiter refilling at rate_per_min / 60 tokens per second."""
+
+    def __init__(self, rate_per_min, capacity=1):
+        self._rate = rate_per_min / 60.0
+        self._capacity = capacity
+        self._tokens = capacity
+        self._updated = time.monotonic()
+        self._lock = asyncio.Lock()
+
+    async def acquire(self):
+        """Wait until a token is available and consume it."""
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                self._tokens = min(self._capacity, self._tokens + (now - self._updated) * self._rate)
+                self._updated = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                await asyncio.sleep((1 - self._tokens) / self._rate)
+
+
+class AdaptiveDelay:
+    """
+    Delay between records shared by all workers, adjusted AIMD-style:
+    shrinks by 10% after each success and doubles after each failed API call,
+    clamped to [min_delay, max_delay].
+    """
+
+    def __init__(self, min_delay, max_delay):
+        self._min = min_delay
+        self._max = max_delay
+        self.current = min_delay
+        self._lock = asyncio.Lock()
+
+    async def success(self):
+        async with self._lock:
+            self.current = max(self._min, self.current * 0.9)
+
+    async def failure(self):
+        async with self._lock:
+            self.current = min(self._max, self.current * 2)
+
+
+class ResponseCache:
+    """Responses by title cache key, sharing in-flight generations between workers."""
+
+    def __init__(self, responses):
+        self.responses = responses
+        self._in_flight = {}
+
+    async def wait(self, key):
+        """Return the cached response for key (or None), first waiting out any in-flight generation of it."""
+        while key in self._in_flight:
+            await asyncio.shield(self._in_flight[key])
+        return self.responses.get(key)
+
+    def start(self, key):
+        """Mark key as being generated so other workers wait for it."""
+        self._in_flight[key] = asyncio.get_running_loop().create_future()
+
+    def finish(self, key, response):
+        """Store the result for key (None on failure) and wake up waiting workers."""
+        if response:
+            self.responses[key] = response
+        self._in_flight.pop(key).set_result(None)
+
+
+async def process_record(client, record, idx, total, limiter, bucket, delay):
+    """Generate the Veo3 prompt for a single record. Returns the JSON text or None."""
+    logger.info("[RECORD %d/%d] Processing ID: %s", idx, total, record['id'])
+    logger.debug("[STEP 2.%d] Product Title: %.100s", idx, record['title'])
+    logger.debug("   → Image: %s bytes", record['img_size'])
+    
+    prompt_text = generate_prompt_text(record)
+    logger.debug("[STEP 3.%d] Generated prompt template (length: %d chars)", idx, len(prompt_text))
+    
+    # Retry logic for prompt submission
+    max_prompt_retries = 4
+    valid_response_received = False
+    cleaned_response = ""
     
-    return text.strip()
+    logger.debug("[STEP 4.%d] Starting API communication (max %d attempts)", idx, max_prompt_retries)
+    
+    for retry_attempt in range(max_prompt_retries):
+        if retry_attempt > 0:
+            logger.warning("⚠️  [RETRY %d/%d] Record %s: previous attempt failed, retrying...",
+                           retry_attempt + 1, max_prompt_retries, record['id'])
+            await asyncio.sleep(3)
+        else:
+            logger.debug("[ATTEMPT %d] Sending prompt to Gemini API...", retry_attempt + 1)
+        
+        try:
+            # Wait for a rate-limit token; hold a concurrency slot only while streaming
+            await bucket.acquire()
+            async with limiter:
+                # Send prompt via API
+                logger.debug("   → Using model: Gemini 3.0 Flash")
+                
+                response_text = await stream_response_text(client, prompt_text)
+            
+            logger.debug("✅ Response received for record %s (%d characters)", record['id'], len(response_text))
+            logger.debug("   → First 200 chars: %.200s...", response_text)
+            
+            logger.debug("[STEP 5.%d] Extracting and validating JSON response...", idx)
+            
+            # Parse the JSON object once and validate it
+            try:
+                parsed_json, cleaned_response = parse_json_response(response_text)
+                if parsed_json is None:
+                    logger.warning("❌ VALIDATION FAILED for record %s: no JSON object in response", record['id'])
+                    continue
+                logger.debug("   → Cleaned JSON length: %d chars", len(cleaned_response))
+                if is_valid_prompt_json(parsed_json):
+                    valid_response_received = True
+                    await delay.success()
+                    logger.info("✅ VALIDATION PASSED for record %s", record['id'])
+                    logger.debug("   → part1_prompt: %.80s...", parsed_json['part1_prompt'])
+                    logger.debug("   → part2_prompt: %.80s...", parsed_json['part2_prompt'])
+                    break
+                else:
+                    logger.warning("❌ VALIDATION FAILED for record %s: missing/invalid prompt fields or echoed "
+                                   "template (found keys: %s)", record['id'], list(parsed_json.keys()))
+                    continue
+            except ValueError as je:
+                logger.warning("❌ VALIDATION FAILED for record %s: invalid JSON format: %s", record['id'], je)
+                logger.debug("   → Attempted to parse: %.200s...", response_text)
+                continue
+        
+        except Exception as e:
+            logger.error("Error during API call for record %s: %s", record['id'], e)
+            
+            await delay.failure()
+            
+            str_error = str(e)
+            # Back off concurrency when Gemini throttles us
+            if "429" in str_error:
+                await limiter.set_limit(limiter.limit - 1)
+                logger.warning("⚠️  Rate limited, lowering concurrency to %d", limiter.limit)
+            
+            # Check if error is related to invalid response (cookie expiration)
+            if "Invalid response" in str_error or "406" in str_error:
+                logger.warning("⚠️  Possible cookie expiration detected. On GitHub Actions, update the "
+                               "GEMINI_COOKIES secret with fresh cookies from https://gemini.google.com")
+
+            if retry_attempt < max_prompt_retries - 1:
+                continue
+            else:
+                raise
+    
+    if not valid_response_received:
+        logger.error("❌ FAILED: Could not get valid response after %d attempts, skipping record ID %s",
+                     max_prompt_retries, record['id'])
+        return None
+    
+    return cleaned_response
 
 
-async def process_records_with_api(client, conn, limit_records=None):
-    """Process pending records using Gemini API."""
+async def worker(client, pool, queue, limiter, bucket, delay, total, pending_updates, cache, unfinished):
+    """Pull records off the queue and process them until cancelled."""
+    while True:
+        idx, record, cache_key = await queue.get()
+        prompt_veo3 = None
+        try:
+            # Duplicate titles wait for the first generation instead of calling Gemini again
+            prompt_veo3 = await cache.wait(cache_key)
+            if prompt_veo3:
+                logger.info("[RECORD %d/%d] Reusing cached response for ID: %s", idx, total, record['id'])
+                # Already in ai_prompt_cache (or inserted with the first record), don't insert it again
+                cache_key = None
+            else:
+                cache.start(cache_key)
+                try:
+                    prompt_veo3 = await process_record(client, record, idx, total, limiter, bucket, delay)
+                finally:
+                    cache.finish(cache_key, prompt_veo3)
+                # Wait before next request, longer while Gemini is pushing back
+                if not queue.empty():
+                    logger.debug("⏳ Waiting %.1f seconds before next record...", delay.current)
+                    await asyncio.sleep(delay.current)
+        except Exception as e:
+            logger.error("Error processing record %s: %s", record['id'], e)
+        try:
+            if prompt_veo3:
+                logger.debug("[STEP 6.%d] Queued record ID %s for saving", idx, record['id'])
+            else:
+                logger.debug("[STEP 6.%d] Queued record ID %s for release back to the queue", idx, record['id'])
+            # Failed records are buffered with None so the flush releases their claim
+            pending_updates.append((record['id'], prompt_veo3, cache_key if prompt_veo3 else None))
+            if len(pending_updates) >= FLUSH_EVERY:
+                unfinished.difference_update(await flush_updates(pool, pending_updates))
+        finally:
+            queue.task_done()
+
+
+async def process_records_with_api(client, pool, limit_records=None):
+    """Process pending records using Gemini API with a pool of concurrent workers."""
     print("\n" + "="*80)
     print("STARTING RECORD PROCESSING")
     print("="*80)
     
-    print("\n[STEP 1] Fetching pending records from database...")
-    records = fetch_pending_records(conn)
+    logger.info("[STEP 1] Fetching pending records from database...")
+    records = await fetch_pending_records(pool)
     
     if not records:
-        print("❌ No pending records found.")
+        logger.info("❌ No pending records found.")
         return
     
-    print(f"✅ Found {len(records)} records to process.")
+    logger.info("✅ Found %d records to process.", len(records))
+    
+    # Claimed ids not yet written back; whatever is left at the end gets released
+    unfinished = {record['id'] for record in records}
+    
+    # Validate titles once up front so prompt building can't fail later
+    invalid = [record['id'] for record in records if not isinstance(record['title'], str)]
+    if invalid:
+        logger.warning("⚠️  Skipping records with missing/invalid title: %s", invalid)
+        records = [record for record in records if isinstance(record['title'], str)]
+        unfinished.difference_update(await mark_records_skipped(pool, invalid))
     
     # Limit to specified number of records for testing
     if limit_records:
         records = records[:limit_records]
-        print(f"⚠️  Processing limited to {limit_records} record(s) for testing\n")
+        logger.warning("⚠️  Processing limited to %d record(s) for testing", limit_records)
     
-    for idx, record in enumerate(records, 1):
-            print(f"\n{'='*80}")
-            print(f"[RECORD {idx}/{len(records)}] Processing ID: {record['id']}")
-            print(f"{'='*80}")
-            print(f"\n[STEP 2.{idx}] Product Title: {record['title'][:100]}..." if len(record['title']) > 100 else f"\n[STEP 2.{idx}] Product Title: {record['title']}")
-            
-            prompt_text = generate_prompt_text(record)
-            print(f"\n[STEP 3.{idx}] Generated prompt template (length: {len(prompt_text) if prompt_text else 0} chars)")
-            
-            if not prompt_text:
-                continue
-            
-            try:
-                # Retry logic for prompt submission
-                max_prompt_retries = 4
-                valid_response_received = False
-                cleaned_response = ""
-                
-                print(f"\n[STEP 4.{idx}] Starting API communication (max {max_prompt_retries} attempts)")
-                
-                for retry_attempt in range(max_prompt_retries):
-                    if retry_attempt > 0:
-                        print(f"\n⚠️  [RETRY {retry_attempt + 1}/{max_prompt_retries}] Previous attempt failed, retrying...")
-                        await asyncio.sleep(3)
-                    else:
-                        print(f"\n[ATTEMPT {retry_attempt + 1}] Sending prompt to Gemini API...")
-                    
-                    try:
-                        # Send prompt via API
-                        print(f"   → Using model: Gemini 2.5 Flash")
-                        print(f"   → Request timestamp: {time.strftime('%Y-%m-%d %H:%M:%S')}")
-                        
-                        response = await client.generate_content(
-                            prompt=prompt_text,
-                            model=Model.G_2_5_FLASH,
-                        )
-                        
-                        # Get response text
-                        response_text = response.text
-                        print(f"\n✅ Response received!")
-                        print(f"   → Response length: {len(response_text)} characters")
-                        print(f"   → First 200 chars: {response_text[:200]}...")
-                        
-                        # Clean and validate JSON
-                        print(f"\n[STEP 5.{idx}] Cleaning and validating JSON response...")
-                        cleaned_response = clean_json_response(response_text)
-                        print(f"   → Cleaned JSON length: {len(cleaned_response)} chars")
-                        
-                        # Check if response contains the original prompt (means Gemini didn't generate properly)
-                        if "You are an Elite AI" in response_text:
-                            print(f"\n❌ VALIDATION FAILED: Response contains original prompt template")
-                            print(f"   → This usually means Gemini echoed the prompt instead of generating")
-                            continue
-                        
-                        # Try to parse JSON to validate
-                        try:
-                            parsed_json = json.loads(cleaned_response)
-                            if "part1_prompt" in parsed_json and "part2_prompt" in parsed_json:
-                                valid_response_received = True
-                                print(f"\n✅ VALIDATION PASSED: Valid JSON with required fields")
-                                print(f"   → part1_prompt: {parsed_json['part1_prompt'][:80]}...")
-                                print(f"   → part2_prompt: {parsed_json['part2_prompt'][:80]}...")
-                                break
-                            else:
-                                print(f"\n❌ VALIDATION FAILED: JSON missing required fields")
-                                print(f"   → Found keys: {list(parsed_json.keys())}")
-                                continue
-                        except json.JSONDecodeError as je:
-                            print(f"\n❌ VALIDATION FAILED: Invalid JSON format")
-                            print(f"   → Error: {je}")
-                            print(f"   → Attempted to parse: {cleaned_response[:200]}...")
-                            continue
-                    
-                    except Exception as e:
-                        print(f"Error during API call: {e}")
-                        
-                        # Check if error is related to invalid response (cookie expiration)
-                        str_error = str(e)
-                        if "Invalid response" in str_error or "406" in str_error:
-                            print("\n⚠️  Possible cookie expiration detected.")
-                            print("   → On GitHub Actions, you need to update the GEMINI_COOKIES secret")
-                            print("   → Get fresh cookies from https://gemini.google.com")
-
-                        if retry_attempt < max_prompt_retries - 1:
-                            continue
-                        else:
-                            raise
-                
-                if not valid_response_received:
-                    print(f"\n❌ FAILED: Could not get valid response after {max_prompt_retries} attempts")
-                    print(f"   → Skipping record ID {record['id']}\n")
-                    continue
-                
-                print(f"\n[STEP 6.{idx}] Saving to database...")
-                # Update database
-                print(f"   → Updating record ID: {record['id']}")
-                update_record(conn, record['id'], cleaned_response)
-                
-            except Exception as e:
-                print(f"Error processing record {record['id']}: {e}")
-            
-            # Wait before next request to avoid rate limits
-            if idx < len(records):
-                print(f"\n⏳ Waiting 15 seconds before next record...\n")
-                await asyncio.sleep(15)
+    # Prefill responses for titles we've already generated, in one query
+    cache_keys = [title_cache_key(record['title']) for record in records]
+    cache = ResponseCache(await fetch_cached_responses(pool, set(cache_keys)))
+    logger.info("→ %d cached response(s) found for this batch", len(cache.responses))
+    
+    queue = asyncio.Queue()
+    for idx, (record, cache_key) in enumerate(zip(records, cache_keys), 1):
+        queue.put_nowait((idx, record, cache_key))
+    
+    limiter = ConcurrencyLimiter(CONCURRENCY)
+    bucket = TokenBucket(RATE_PER_MIN)
+    delay = AdaptiveDelay(MIN_DELAY, MAX_DELAY)
+    logger.info("→ Running %d worker(s), max %g requests/min", CONCURRENCY, RATE_PER_MIN)
+    
+    pending_updates = []
+    workers = [
+        asyncio.create_task(worker(
+            client, pool, queue, limiter, bucket, delay, len(records), pending_updates, cache, unfinished
+        ))
+        for _ in range(CONCURRENCY)
+    ]
+    try:
+        await queue.join()
+    finally:
+        for task in workers:
+            task.cancel()
+        await asyncio.gather(*workers, return_exceptions=True)
+        # Flush whatever is left and release every claimed record that wasn't
+        # written (cancelled run, records cut by limit_records), so claimed
+        # records aren't orphaned
+        buffered = {record_id for record_id, _, _ in pending_updates}
+        pending_updates.extend((record_id, None, None) for record_id in unfinished - buffered)
+        await flush_updates(pool, pending_updates)
 
 
 async def main():
@@ -334,7 +651,7 @@ async def main():
     
     # Try loading from environment variable first (for GitHub Actions)
     print(f"  → Trying GEMINI_COOKIES environment variable...")
-    cookies = load_cookies_from_env()
+    cookies = parse_cookies(os.getenv("GEMINI_COOKIES", ""))
     if cookies:
         print(f"  ✅ Loaded {len(cookies)} cookies from environment variable")
     
@@ -342,7 +659,8 @@ async def main():
     if not cookies:
         try:
             print(f"  → Trying cookies.txt at {COOKIES_FILE}...")
-            cookies = load_cookies_from_file(COOKIES_FILE)
+            with open(COOKIES_FILE, 'r', encoding='utf-8') as f:
+                cookies = parse_cookies(f.read())
             print(f"  ✅ Loaded {len(cookies)} cookies from file")
         except Exception as e:
             print(f"  ⚠️ Failed to load from file: {e}")
@@ -370,8 +688,8 @@ async def main():
     
     # Connect to database
     print(f"\nConnecting to database...")
-    conn = get_db_connection()
-    if not conn:
+    pool = await get_db_pool()
+    if not pool:
         print("ERROR: Failed to connect to database")
         return
     print("Database connected successfully")
@@ -387,6 +705,8 @@ async def main():
             proxy=None
         )
         
+        # auto_close=False keeps the HTTP session (and its TLS connections)
+        # open across all records; it is closed once at shutdown
         await client.init(
             timeout=60,
             auto_close=False,
@@ -410,7 +730,7 @@ async def main():
         print(f"3. Go to 'Application' tab → 'Cookies' → 'https://gemini.google.com'")
         print(f"4. Copy the values of __Secure-1PSID and __Secure-1PSIDTS")
         print(f"5. Format: __Secure-1PSID=xxx;__Secure-1PSIDTS=yyy")
-        conn.close()
+        await pool.close()
         return
     
     # Process all pending records
@@ -419,7 +739,7 @@ async def main():
     print("="*80)
     
     try:
-        await process_records_with_api(client, conn)
+        await process_records_with_api(client, pool)
     except KeyboardInterrupt:
         print("\n\nScript interrupted by user")
     except Exception as e:
@@ -428,9 +748,19 @@ async def main():
         # Cleanup
         print("\nClosing connections...")
         await client.close()
-        conn.close()
+        await pool.close()
         print("Script finished.")
 
 
 if __name__ == "__main__":
-    asyncio.run(main())
+    # Use the libuv-based event loop where available (not supported on Windows)
+    uvloop = None
+    if sys.platform != "win32":
+        try:
+            import uvloop
+        except ImportError:
+            pass
+    if uvloop is not None:
+        uvloop.run(main())
+    else:
+        asyncio.run(main())
@@ -0,0 +1,8 @@
+-- Partial index covering only the rows fetch_pending_records() can claim,
+-- so the claim scan is proportional to the batch size, not the table size.
+-- CONCURRENTLY cannot run inside a transaction block: run this file on its own.
+CREATE INDEX CONCURRENTLY IF NOT EXISTS products_ai_pending_idx
+    ON products_ai (id)
+    WHERE prompt_veo3 IS NULL
+      AND category = 'vip'
+      AND crawl_status IS NULL;
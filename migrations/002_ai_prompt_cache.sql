@@ -0,0 +1,8 @@
+-- Generated Veo3 prompts keyed by sha256 of the normalised product title, so
+-- records with duplicate titles reuse an earlier response instead of calling
+-- Gemini again. See title_cache_key() in gen.py.
+CREATE TABLE IF NOT EXISTS ai_prompt_cache (
+    title_hash BYTEA PRIMARY KEY,
+    response TEXT NOT NULL,
+    created_at TIMESTAMPTZ NOT NULL DEFAULT NOW()
+);
@@ -0,0 +1,7 @@
+-- Store generated prompts as JSONB so they are parsed once on write instead
+-- of by every consumer. Existing values are already validated JSON text.
+ALTER TABLE products_ai
+    ALTER COLUMN prompt_veo3 TYPE JSONB USING prompt_veo3::jsonb;
+
+ALTER TABLE ai_prompt_cache
+    ALTER COLUMN response TYPE JSONB USING response::jsonb;
@@ -0,0 +1,9 @@
+-- Release rows that were claimed but never finished (crawl_status = TRUE with
+-- no prompt), so fetch_pending_records() picks them up again.
+-- Only run this while no gen.py job is active, otherwise rows held by a running
+-- job are released and processed twice. Safe to re-run to recover from a
+-- crashed job.
+UPDATE products_ai
+SET crawl_status = NULL
+WHERE crawl_status = TRUE
+  AND prompt_veo3 IS NULL;